@@ -4,10 +4,16 @@ import logging
 import sqlite3
 import subprocess
 import tempfile
-import shutil
-from datetime import datetime
-import pytz
+import atexit
+import threading
+import itertools
+import time
+import random
 import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from collections import OrderedDict
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from pytubefix import YouTube, exceptions  # Menggunakan pytubefix sebagai pengganti pytube
@@ -15,7 +21,6 @@ import re
 import httpx
 from urllib.error import HTTPError
 from telegram.helpers import escape_markdown  # Untuk menghindari error parse entities
-from pydub import AudioSegment
 
 # Konfigurasi logging
 logging.basicConfig(
@@ -24,13 +29,93 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Konfigurasi bot: token dibaca dari environment, bukan di-hardcode di source
+_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
+_ADMIN_IDS = frozenset({1390557485})
+
 # Konfigurasi database
 DATABASE_FILE = "youtube_downloader_bot.db"
-WIB = pytz.timezone('Asia/Jakarta')
+# WIB (Asia/Jakarta) tidak memiliki DST, jadi offset tetap UTC+7 cukup tanpa lookup pytz
+WIB_OFFSET = 7 * 3600
+_timestamp_cache = (None, "")
+
+def now_wib_str():
+    # Format string di-cache per detik karena resolusi kolom timestamp hanya detik
+    global _timestamp_cache
+    second = int(time.time())
+    if _timestamp_cache[0] != second:
+        _timestamp_cache = (second, time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(second + WIB_OFFSET)))
+    return _timestamp_cache[1]
+
+# Pragma per-koneksi (tidak tersimpan di file database, harus di-set setiap open)
+_CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA busy_timeout=5000",
+)
+
+# Koneksi long-lived: satu writer (dijaga lock) dan satu reader read-only untuk statistik
+_WRITE_CONN = None
+_READ_CONN = None
+_WRITE_LOCK = threading.Lock()
+# Semua akses tulis DB dari event loop dijalankan di thread khusus, bukan di default
+# executor yang juga dipakai unduhan, agar commit tidak antre di belakang unduhan
+_DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+# Antrian log: ditulis per batch oleh _log_writer dalam satu transaksi
+LOG_BATCH_SIZE = 64
+LOG_BATCH_TIMEOUT = 0.1
+_log_queue = None
+_log_writer_task = None
+_log_id_counter = None
+_LOG_STOP = object()
+
+def _connect(read_only=False):
+    if read_only:
+        conn = sqlite3.connect(f"file:{DATABASE_FILE}?mode=ro", uri=True, isolation_level=None, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(DATABASE_FILE, isolation_level=None, check_same_thread=False)
+    for pragma in _CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+async def run_db(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_DB_EXECUTOR, func, *args)
+
+def open_connections():
+    global _WRITE_CONN, _READ_CONN, _log_id_counter
+    _WRITE_CONN = _connect()
+    _READ_CONN = _connect(read_only=True)
+    # ID log dialokasikan di memori agar log_usage bisa langsung mengembalikan log_id
+    cursor = _WRITE_CONN.execute("SELECT COALESCE(MAX(id), 0) FROM usage_logs")
+    last_id = cursor.fetchone()[0]
+    cursor = _WRITE_CONN.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'usage_logs'")
+    last_id = max(last_id, cursor.fetchone()[0])
+    _log_id_counter = itertools.count(last_id + 1)
+    atexit.register(close_connections)
+
+def close_connections():
+    global _WRITE_CONN, _READ_CONN
+    if _log_queue is not None:
+        _flush_log_queue()
+    for conn in (_READ_CONN, _WRITE_CONN):
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.error(f"Gagal menutup koneksi database: {str(e)}")
+    _WRITE_CONN = None
+    _READ_CONN = None
+
+SCHEMA_VERSION = 2
 
 def init_database():
-    conn = sqlite3.connect(DATABASE_FILE)
+    conn = _connect()
     cursor = conn.cursor()
+    # WAL tersimpan di file database, cukup di-set sekali saat inisialisasi
+    cursor.execute("PRAGMA journal_mode=WAL")
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS users (
         user_id INTEGER PRIMARY KEY,
@@ -54,56 +139,150 @@ def init_database():
     )
     ''')
     conn.commit()
-    cursor.execute("PRAGMA table_info(usage_logs)")
-    columns = [info[1] for info in cursor.fetchall()]
-    if "error_message" not in columns:
+    # Versi skema disimpan di PRAGMA user_version; tiap langkah migrasi hanya jalan sekali
+    cursor.execute("PRAGMA user_version")
+    version = cursor.fetchone()[0]
+    if version < SCHEMA_VERSION:
         try:
-            cursor.execute("ALTER TABLE usage_logs ADD COLUMN error_message TEXT")
-            logger.info("Migrasi: Kolom error_message berhasil ditambahkan ke usage_logs")
+            if version < 1:
+                # Database lama bisa saja sudah punya kolom error_message (user_version masih 0)
+                cursor.execute("PRAGMA table_info(usage_logs)")
+                columns = [info[1] for info in cursor.fetchall()]
+                if "error_message" not in columns:
+                    cursor.execute("ALTER TABLE usage_logs ADD COLUMN error_message TEXT")
+                    logger.info("Migrasi: Kolom error_message berhasil ditambahkan ke usage_logs")
+            if version < 2:
+                # Index untuk query di get_user_stats agar tidak full scan usage_logs
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_action_status ON usage_logs(action, status)")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_errors ON usage_logs(timestamp DESC) WHERE error_message != ''")
+                cursor.execute("ANALYZE")
+                logger.info("Migrasi: Index usage_logs berhasil dibuat")
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
             conn.commit()
         except Exception as e:
             logger.error(f"Migrasi gagal: {str(e)}")
     conn.close()
 
+# Statement SQL untuk jalur tulis, di-hoist agar tidak dibuat ulang per panggilan
+_SQL_SELECT_USER = "SELECT user_id FROM users WHERE user_id = ?"
+_SQL_INSERT_USER = "INSERT INTO users (user_id, username, first_name, last_name, join_date) VALUES (?, ?, ?, ?, ?)"
+_SQL_INSERT_LOG = "INSERT INTO usage_logs (id, user_id, action, video_url, format, quality, timestamp, status, error_message) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+_SQL_UPDATE_LOG = "UPDATE usage_logs SET status = ?, error_message = ? WHERE id = ?"
+
 def save_user(user_id, username, first_name, last_name):
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-    if cursor.fetchone() is None:
-        join_date = datetime.now(WIB).strftime("%Y-%m-%d %H:%M:%S")
-        cursor.execute(
-            "INSERT INTO users (user_id, username, first_name, last_name, join_date) VALUES (?, ?, ?, ?, ?)",
-            (user_id, username, first_name, last_name, join_date)
-        )
-        conn.commit()
-    conn.close()
+    with _WRITE_LOCK:
+        cursor = _WRITE_CONN.cursor()
+        cursor.execute(_SQL_SELECT_USER, (user_id,))
+        if cursor.fetchone() is None:
+            join_date = now_wib_str()
+            cursor.execute(_SQL_INSERT_USER, (user_id, username, first_name, last_name, join_date))
+
+def _write_log_batch(batch):
+    # batch berisi tuple (jenis, parameter) dengan urutan sesuai pemanggilan;
+    # operasi berurutan yang sejenis digabung menjadi satu executemany
+    with _WRITE_LOCK:
+        _WRITE_CONN.execute("BEGIN IMMEDIATE")
+        try:
+            for kind, group in itertools.groupby(batch, key=lambda item: item[0]):
+                rows = [params for _, params in group]
+                if kind == "insert":
+                    _WRITE_CONN.executemany(_SQL_INSERT_LOG, rows)
+                else:
+                    _WRITE_CONN.executemany(_SQL_UPDATE_LOG, rows)
+            _WRITE_CONN.execute("COMMIT")
+        except Exception:
+            _WRITE_CONN.execute("ROLLBACK")
+            raise
+
+def _enqueue_log(item):
+    if _log_queue is None:
+        # Writer belum berjalan (mis. sebelum post_init), tulis langsung
+        _write_log_batch([item])
+    else:
+        _log_queue.put_nowait(item)
+
+def _write_log_batch_safe(batch):
+    # Jika satu baris gagal, batch di-rollback; tulis ulang per baris agar
+    # hanya baris bermasalah yang dibuang (dan dicatat di log)
+    try:
+        _write_log_batch(batch)
+    except Exception as e:
+        logger.error(f"Gagal menulis {len(batch)} log sekaligus, mencoba per baris: {str(e)}")
+        for item in batch:
+            try:
+                _write_log_batch([item])
+            except Exception as e:
+                logger.error(f"Log dibuang {item}: {str(e)}")
+
+def _flush_log_queue():
+    batch = []
+    while not _log_queue.empty():
+        item = _log_queue.get_nowait()
+        if item is not _LOG_STOP:
+            batch.append(item)
+    if batch:
+        _write_log_batch_safe(batch)
+
+async def _log_writer():
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await _log_queue.get()
+        if item is _LOG_STOP:
+            return
+        batch = [item]
+        stop = False
+        try:
+            deadline = loop.time() + LOG_BATCH_TIMEOUT
+            while len(batch) < LOG_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(_log_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _LOG_STOP:
+                    stop = True
+                    break
+                batch.append(item)
+        except asyncio.CancelledError:
+            # Batch sudah diambil dari antrian, tulis dulu sebelum berhenti
+            _write_log_batch_safe(batch)
+            raise
+        await run_db(_write_log_batch_safe, batch)
+        if stop:
+            return
+
+async def start_log_writer(application):
+    global _log_queue, _log_writer_task
+    _log_queue = asyncio.Queue()
+    _log_writer_task = asyncio.create_task(_log_writer())
+
+async def stop_log_writer(application):
+    global _log_queue, _log_writer_task
+    if _log_writer_task is not None:
+        # Sentinel membuat writer menulis batch yang sedang dikumpulkan lalu berhenti
+        _log_queue.put_nowait(_LOG_STOP)
+        try:
+            await _log_writer_task
+        except asyncio.CancelledError:
+            pass
+        _log_writer_task = None
+    if _log_queue is not None:
+        _flush_log_queue()
+        _log_queue = None
 
 def log_usage(user_id, action, video_url="", format="", quality="", status="started", error_message=""):
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    timestamp = datetime.now(WIB).strftime("%Y-%m-%d %H:%M:%S")
-    cursor.execute(
-        "INSERT INTO usage_logs (user_id, action, video_url, format, quality, timestamp, status, error_message) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-        (user_id, action, video_url, format, quality, timestamp, status, error_message)
-    )
-    conn.commit()
-    last_id = cursor.lastrowid
-    conn.close()
-    return last_id
+    log_id = next(_log_id_counter)
+    timestamp = now_wib_str()
+    _enqueue_log(("insert", (log_id, user_id, action, video_url, format, quality, timestamp, status, error_message)))
+    return log_id
 
 def update_log_status(log_id, status, error_message=""):
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE usage_logs SET status = ?, error_message = ? WHERE id = ?",
-        (status, error_message, log_id)
-    )
-    conn.commit()
-    conn.close()
+    _enqueue_log(("update", (status, error_message, log_id)))
 
 def get_user_stats():
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
+    cursor = _READ_CONN.cursor()
     cursor.execute("SELECT COUNT(DISTINCT user_id) FROM users")
     total_users = cursor.fetchone()[0]
     cursor.execute("SELECT COUNT(*) FROM usage_logs WHERE action = 'download'")
@@ -126,7 +305,6 @@ def get_user_stats():
     LIMIT 5
     """)
     recent_errors = cursor.fetchall()
-    conn.close()
     return {
         "total_users": total_users,
         "total_downloads": total_downloads,
@@ -134,71 +312,146 @@ def get_user_stats():
         "recent_errors": recent_errors
     }
 
+_YT_URL_RE = re.compile(r'(https?://)?(www\.)?(youtube\.com/watch\?v=|youtu\.be/)[a-zA-Z0-9_-]+')
+_YT_ID_RE = re.compile(r'(?:https?:\/\/)?(?:www\.)?(?:youtube\.com\/watch\?v=|youtu\.be\/)([a-zA-Z0-9_-]+)')
+
 def is_valid_youtube_url(url):
-    youtube_regex = r'(https?://)?(www\.)?(youtube\.com/watch\?v=|youtu\.be/)[a-zA-Z0-9_-]+'
-    return bool(re.match(youtube_regex, url))
+    return bool(_YT_URL_RE.match(url))
 
 def extract_video_id(url):
-    pattern1 = r'(?:https?:\/\/)?(?:www\.)?youtube\.com\/watch\?v=([a-zA-Z0-9_-]+)'
-    pattern2 = r'(?:https?:\/\/)?(?:www\.)?youtu\.be\/([a-zA-Z0-9_-]+)'
-    match = re.search(pattern1, url)
-    if match:
-        return match.group(1)
-    match = re.search(pattern2, url)
+    match = _YT_ID_RE.search(url)
     if match:
         return match.group(1)
     return None
 
 ALLOWED_VIDEO_RESOLUTIONS = {"144p", "240p", "360p", "480p", "720p", "1080p"}
 
-def merge_video_audio(video_file, audio_file, output_file):
-    cmd = ['ffmpeg', '-y', '-i', video_file, '-i', audio_file, '-c:v', 'copy', '-c:a', 'aac', output_file]
-    subprocess.run(cmd, capture_output=True, check=True)
+# Batas stderr ffmpeg yang disimpan untuk diagnosa saat gagal
+FFMPEG_STDERR_TAIL = 4096
+
+def _read_stderr_tail(stderr_file):
+    stderr_file.seek(0, os.SEEK_END)
+    stderr_file.seek(max(0, stderr_file.tell() - FFMPEG_STDERR_TAIL))
+    return stderr_file.read()
+
+def _decode_stderr(stderr):
+    return stderr.decode(errors="replace") if stderr else ""
+
+# Codec audio yang bisa langsung di-mux ke MP4 tanpa re-encode
+AAC_CODECS = {"aac", "mp4a.40.2", "mp4a.40.5"}
 
-# Fungsi konversi ke MP3 menggunakan pydub
+async def merge_video_audio(video_file, audio_file, output_file, audio_codec=None):
+    audio_args = ['-c:a', 'copy' if audio_codec in AAC_CODECS else 'aac']
+    cmd = ['ffmpeg', '-y', '-nostats', '-i', video_file, '-i', audio_file, '-c:v', 'copy', *audio_args, '-movflags', '+faststart', output_file]
+    # stderr ke file temporary (bukan pipe) agar output ffmpeg tidak menumpuk di memori
+    with tempfile.TemporaryFile() as stderr_file:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=stderr_file
+        )
+        await proc.wait()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=_read_stderr_tail(stderr_file))
+
+# Fungsi konversi ke MP3 langsung dengan ffmpeg (satu proses, tanpa WAV perantara)
 def convert_to_mp3(file_path):
     base, ext = os.path.splitext(file_path)
     if ext.lower() != ".mp3":
         try:
-            audio = AudioSegment.from_file(file_path)
             mp3_path = base + ".mp3"
-            audio.export(mp3_path, format="mp3")
+            cmd = ['ffmpeg', '-y', '-nostats', '-i', file_path, '-vn', '-c:a', 'libmp3lame', '-b:a', '192k', mp3_path]
+            with tempfile.TemporaryFile() as stderr_file:
+                result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr_file)
+                if result.returncode != 0:
+                    raise subprocess.CalledProcessError(result.returncode, cmd, stderr=_read_stderr_tail(stderr_file))
             os.remove(file_path)
             return mp3_path
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Error converting to mp3: {str(e)}\n{_decode_stderr(e.stderr)}")
+            return file_path
         except Exception as e:
             logger.error(f"Error converting to mp3: {str(e)}")
             return file_path
     return file_path
 
-# Fungsi retry untuk get_video_info
+# Cache video info per video_id (LRU + TTL) agar button_handler tidak fetch ulang
+INFO_CACHE_TTL = 600
+INFO_CACHE_MAX_SIZE = 128
+_INFO_CACHE = OrderedDict()
+
+def _cache_video_info(video_id, info, yt):
+    # Objek YouTube ikut disimpan agar download_youtube tidak fetch halaman + decipher ulang
+    _INFO_CACHE[video_id] = (time.monotonic(), info, yt)
+    _INFO_CACHE.move_to_end(video_id)
+    while len(_INFO_CACHE) > INFO_CACHE_MAX_SIZE:
+        _INFO_CACHE.popitem(last=False)
+
+def _get_cache_entry(video_id):
+    entry = _INFO_CACHE.get(video_id)
+    if entry is None:
+        return None
+    if time.monotonic() - entry[0] > INFO_CACHE_TTL:
+        del _INFO_CACHE[video_id]
+        return None
+    _INFO_CACHE.move_to_end(video_id)
+    return entry
+
+def _get_cached_video_info(video_id):
+    entry = _get_cache_entry(video_id)
+    return entry[1] if entry else None
+
+def _get_cached_youtube(video_id):
+    entry = _get_cache_entry(video_id)
+    return entry[2] if entry else None
+
+# Fungsi retry untuk get_video_info dengan exponential backoff + jitter
 async def get_video_info_with_retry(url, retries=3):
+    delay = 0.25
     for attempt in range(retries):
         info = await get_video_info(url)
         if info and "error" not in info:
             return info
-        logger.warning(f"Attempt {attempt+1} gagal mendapatkan video info. Retrying...")
-        await asyncio.sleep(1)
+        # Error permanen (video tidak tersedia / URL tidak dikenali) tidak perlu di-retry
+        if info and info.get("permanent"):
+            return info
+        if attempt + 1 < retries:
+            logger.warning(f"Attempt {attempt+1} gagal mendapatkan video info. Retrying...")
+            await asyncio.sleep(delay + random.random() * 0.1)
+            delay *= 2
     return info
 
 # Helper: Ambil video info berdasarkan video ID
 async def get_video_info_by_id(video_id):
+    info = _get_cached_video_info(video_id)
+    if info is not None:
+        return info
     url = f"https://youtu.be/{video_id}"
     return await get_video_info_with_retry(url)
 
+# Dijalankan di thread: fetch halaman, parsing manifest stream dan decipher JS player
+# semuanya blocking
+def _load_youtube(url):
+    # Coba terlebih dahulu dengan client WEB dan use_po_token True
+    try:
+        yt = YouTube(url, use_po_token=True, client="WEB")
+    except Exception as e:
+        # Jika terjadi error EOF atau error lainnya, fallback ke client ANDROID
+        if "EOF" in str(e) or "bot" in str(e).lower():
+            logger.warning("Client WEB gagal, mencoba fallback ke client ANDROID")
+            yt = YouTube(url, client="ANDROID")
+        else:
+            raise e
+    # Akses streams dan title di sini agar hasilnya sudah ter-cache di objek yt
+    _ = yt.streams, yt.title
+    return yt
+
 async def get_video_info(url):
     try:
         video_id = extract_video_id(url)
         logger.info(f"Attempting to get info for video ID: {video_id}")
-        # Coba terlebih dahulu dengan client WEB dan use_po_token True
-        try:
-            yt = YouTube(url, use_po_token=True, client="WEB")
-        except Exception as e:
-            # Jika terjadi error EOF atau error lainnya, fallback ke client ANDROID
-            if "EOF" in str(e) or "bot" in str(e).lower():
-                logger.warning("Client WEB gagal, mencoba fallback ke client ANDROID")
-                yt = YouTube(url, client="ANDROID")
-            else:
-                raise e
+        yt = await asyncio.to_thread(_load_youtube, url)
         audio_streams = yt.streams.filter(only_audio=True).order_by('abr').desc()
         audio_options = []
         for stream in audio_streams:
@@ -220,11 +473,13 @@ async def get_video_info(url):
                     'extension': stream.subtype,
                     'ptype': 'prog'
                 })
+        seen_resolutions = {opt['quality'] for opt in video_options}
         video_streams_adapt = yt.streams.filter(only_video=True, file_extension='mp4').order_by('resolution').desc()
         for stream in video_streams_adapt:
             if stream.resolution in ALLOWED_VIDEO_RESOLUTIONS:
-                if any(opt['quality'] == stream.resolution for opt in video_options):
+                if stream.resolution in seen_resolutions:
                     continue
+                seen_resolutions.add(stream.resolution)
                 video_options.append({
                     'itag': stream.itag,
                     'format': 'video',
@@ -235,7 +490,7 @@ async def get_video_info(url):
         if not audio_options and not video_options:
             logger.warning(f"No streams available for {url}")
             return None
-        return {
+        info = {
             'title': yt.title,
             'thumbnail': yt.thumbnail_url,
             'duration': yt.length,
@@ -243,10 +498,13 @@ async def get_video_info(url):
             'audio_options': audio_options[:3],
             'video_options': video_options[:10]
         }
+        if video_id:
+            _cache_video_info(video_id, info, yt)
+        return info
     except (exceptions.RegexMatchError, exceptions.VideoUnavailable) as e:
         error_msg = f"Video tidak tersedia atau dibatasi: {str(e)}"
         logger.error(f"YouTube error: {error_msg}")
-        return {"error": error_msg}
+        return {"error": error_msg, "permanent": True}
     except HTTPError as e:
         error_msg = f"HTTP Error {e.code}: {e.reason}"
         logger.error(f"HTTP error: {error_msg}")
@@ -256,72 +514,98 @@ async def get_video_info(url):
         logger.error(f"Error getting video info: {error_msg}")
         return {"error": error_msg}
 
-async def download_youtube(url, itag, format_type, user_id, log_id, ptype="prog"):
+# Update diproses paralel, tetapi unduhan/ffmpeg dibatasi agar burst user tidak
+# menjalankan transcode tanpa batas
+MAX_CONCURRENT_UPDATES = 64
+MAX_CONCURRENT_DOWNLOADS = 4
+_DOWNLOAD_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+# Unduhan adaptive memakai 2 thread (video + audio), jadi pool harus lebih besar dari
+# MAX_CONCURRENT_DOWNLOADS * 2 agar tidak ada stream yang menunggu thread kosong
+_DOWNLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS * 2 + 1, thread_name_prefix="download")
+
+async def run_download(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_DOWNLOAD_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+async def download_youtube(url, itag, format_type, user_id, log_id, temp_dir, ptype="prog"):
     try:
         video_id = extract_video_id(url)
         logger.info(f"Downloading video ID: {video_id} with itag: {itag}")
-        # Gunakan fallback seperti di get_video_info
-        try:
-            yt = YouTube(url, use_po_token=True, client="WEB")
-        except Exception as e:
-            if "EOF" in str(e) or "bot" in str(e).lower():
-                logger.warning("Client WEB gagal, mencoba fallback ke client ANDROID")
-                yt = YouTube(url, client="ANDROID")
-            else:
-                raise e
-        # Buat direktori temporary
-        temp_dir = tempfile.mkdtemp()
+        # Pakai objek YouTube dari cache get_video_info jika masih ada
+        yt = _get_cached_youtube(video_id) if video_id else None
+        if yt is None:
+            yt = await asyncio.to_thread(_load_youtube, url)
         if format_type == 'video' and ptype == 'adapt':
             video_stream = yt.streams.get_by_itag(itag)
             if not video_stream:
                 error_msg = f"Stream dengan itag {itag} tidak tersedia"
                 logger.error(error_msg)
                 update_log_status(log_id, "failed", error_msg)
-                shutil.rmtree(temp_dir)
-                return None, None
-            video_path = video_stream.download(output_path=temp_dir, filename_prefix="video_")
-            audio_stream = yt.streams.filter(only_audio=True).order_by('abr').desc().first()
+                return None
+            # Utamakan audio m4a (AAC) agar merge cukup stream copy tanpa transcode
+            audio_stream = (
+                yt.streams.filter(only_audio=True, subtype='mp4').order_by('abr').desc().first()
+                or yt.streams.filter(only_audio=True).order_by('abr').desc().first()
+            )
             if not audio_stream:
                 error_msg = "Audio stream tidak tersedia untuk penggabungan adaptive video"
                 logger.error(error_msg)
                 update_log_status(log_id, "failed", error_msg)
-                shutil.rmtree(temp_dir)
-                return None, None
-            audio_path = audio_stream.download(output_path=temp_dir, filename_prefix="audio_")
+                return None
+            # Unduh stream video dan audio secara paralel; tunggu keduanya selesai
+            # sebelum melempar error agar tidak ada thread yang masih menulis ke temp_dir
+            results = await asyncio.gather(
+                run_download(video_stream.download, output_path=temp_dir, filename_prefix="video_"),
+                run_download(audio_stream.download, output_path=temp_dir, filename_prefix="audio_"),
+                return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            video_path, audio_path = results
             output_path = os.path.join(temp_dir, f"{yt.title}_{video_id}.mp4")
-            merge_video_audio(video_path, audio_path, output_path)
+            # ffmpeg harus mem-probe kedua input sebelum mux, jadi merge dimulai begitu
+            # kedua unduhan selesai; subprocess async membuat event loop tetap bebas
+            # melayani user lain selama remux berjalan
+            await merge_video_audio(video_path, audio_path, output_path, audio_stream.audio_codec)
             os.remove(video_path)
             os.remove(audio_path)
             update_log_status(log_id, "completed")
-            return output_path, temp_dir
+            return output_path
         else:
             stream = yt.streams.get_by_itag(itag)
             if not stream:
                 error_msg = f"Stream dengan itag {itag} tidak tersedia"
                 logger.error(error_msg)
                 update_log_status(log_id, "failed", error_msg)
-                shutil.rmtree(temp_dir)
-                return None, None
-            file_path = stream.download(output_path=temp_dir)
+                return None
+            file_path = await run_download(stream.download, output_path=temp_dir)
             if format_type == "audio":
-                file_path = convert_to_mp3(file_path)
+                file_path = await run_download(convert_to_mp3, file_path)
             update_log_status(log_id, "completed")
-            return file_path, temp_dir
+            return file_path
     except exceptions.VideoUnavailable as e:
         error_msg = f"Video tidak tersedia: {str(e)}"
         logger.error(error_msg)
         update_log_status(log_id, "failed", error_msg)
-        return None, None
+        return None
+    except subprocess.CalledProcessError as e:
+        error_msg = f"Error menggabungkan video dan audio: {str(e)}"
+        logger.error(f"{error_msg}\n{_decode_stderr(e.stderr)}")
+        update_log_status(log_id, "failed", error_msg)
+        return None
     except Exception as e:
         error_msg = f"Error mengunduh video: {str(e)}"
         logger.error(error_msg)
         update_log_status(log_id, "failed", error_msg)
-        return None, None
+        return None
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user = update.effective_user
-        save_user(user.id, user.username, user.first_name, user.last_name)
+        # save_user memakai _WRITE_LOCK yang bisa ditahan writer log selama commit batch,
+        # jadi jalankan di thread agar event loop tidak ikut menunggu
+        await run_db(save_user, user.id, user.username, user.first_name, user.last_name)
         log_usage(user.id, "start")
         await update.message.reply_text(
             f"Halo {user.first_name}! Selamat datang di YouTube Downloader Bot.\n\n"
@@ -331,28 +615,32 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in start command: {str(e)}")
         await update.message.reply_text("Terjadi kesalahan saat memulai bot. Silakan coba lagi.")
 
+# Teks bantuan statis, cukup di-escape sekali saat import
+_HELP_TEXT_MD2 = escape_markdown(
+    (
+        "🔰 *Bantuan YouTube Downloader Bot* 🔰\n\n"
+        "*Perintah Tersedia:*\n"
+        "/start - Memulai bot\n"
+        "/help - Menampilkan pesan bantuan ini\n"
+        "/stats - Melihat statistik bot (hanya admin)\n\n"
+        "*Cara Penggunaan:*\n"
+        "1. Kirim URL video YouTube (contoh: https://youtube.com/watch?v=xxxx atau https://youtu.be/xxxx)\n"
+        "2. Pilih format yang diinginkan:\n"
+        "   • Audio: Dropdown pilihan kualitas audio (akan dikonversi ke MP3 jika diperlukan)\n"
+        "   • Video: Dropdown pilihan resolusi (misal: 144p, 480p, 720p, 1080p, dll.)\n"
+        "3. Pilih opsi dari dropdown\n"
+        "4. Tunggu hingga proses unduhan selesai\n"
+        "5. File akan dikirim ke chat Anda\n\n"
+        "⚠️ *Catatan:* Jika terjadi error, silakan coba URL lain atau hubungi admin."
+    ),
+    version=2
+)
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user = update.effective_user
         log_usage(user.id, "help")
-        help_text = (
-            "🔰 *Bantuan YouTube Downloader Bot* 🔰\n\n"
-            "*Perintah Tersedia:*\n"
-            "/start - Memulai bot\n"
-            "/help - Menampilkan pesan bantuan ini\n"
-            "/stats - Melihat statistik bot (hanya admin)\n\n"
-            "*Cara Penggunaan:*\n"
-            "1. Kirim URL video YouTube (contoh: https://youtube.com/watch?v=xxxx atau https://youtu.be/xxxx)\n"
-            "2. Pilih format yang diinginkan:\n"
-            "   • Audio: Dropdown pilihan kualitas audio (akan dikonversi ke MP3 jika diperlukan)\n"
-            "   • Video: Dropdown pilihan resolusi (misal: 144p, 480p, 720p, 1080p, dll.)\n"
-            "3. Pilih opsi dari dropdown\n"
-            "4. Tunggu hingga proses unduhan selesai\n"
-            "5. File akan dikirim ke chat Anda\n\n"
-            "⚠️ *Catatan:* Jika terjadi error, silakan coba URL lain atau hubungi admin."
-        )
-        safe_text = escape_markdown(help_text, version=2)
-        await update.message.reply_text(safe_text, parse_mode='MarkdownV2')
+        await update.message.reply_text(_HELP_TEXT_MD2, parse_mode='MarkdownV2')
     except Exception as e:
         logger.error(f"Error in help command: {str(e)}")
         await update.message.reply_text("Terjadi kesalahan saat menampilkan bantuan. Silakan coba lagi.")
@@ -360,8 +648,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user = update.effective_user
-        ADMIN_IDS = [1390557485]
-        if user.id not in ADMIN_IDS:
+        if user.id not in _ADMIN_IDS:
             await update.message.reply_text("Maaf, Anda tidak memiliki izin untuk mengakses statistik.")
             return
         log_usage(user.id, "stats")
@@ -383,6 +670,9 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in stats command: {str(e)}")
         await update.message.reply_text("Terjadi kesalahan saat mengambil statistik. Silakan coba lagi.")
 
+# Baris tombol Batal yang dipakai ulang di setiap keyboard
+_CANCEL_ROW = [InlineKeyboardButton("❌ Batal", callback_data="cancel")]
+
 async def url_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     url = update.message.text
     user = update.effective_user
@@ -410,7 +700,7 @@ async def url_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard = [
             [InlineKeyboardButton("🎵 Audio", callback_data=f"option|{vid_id}|audio")],
             [InlineKeyboardButton("🎬 Video", callback_data=f"option|{vid_id}|video")],
-            [InlineKeyboardButton("❌ Batal", callback_data="cancel")]
+            _CANCEL_ROW
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
@@ -446,24 +736,25 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not video_info or "error" in video_info:
                 await query.edit_message_text("❌ Gagal mengambil opsi. Silakan coba URL lain.")
                 return
-            keyboard = []
             if choice == "audio":
-                for audio in video_info['audio_options']:
-                    keyboard.append([
-                        InlineKeyboardButton(
-                            f"🎵 Audio {audio['quality']} ({audio['extension']})",
-                            callback_data=f"download|{vid_id}|{audio['itag']}|audio|{audio['quality']}"
-                        )
-                    ])
+                keyboard = [
+                    [InlineKeyboardButton(
+                        f"🎵 Audio {audio['quality']} ({audio['extension']})",
+                        callback_data=f"download|{vid_id}|{audio['itag']}|audio|{audio['quality']}"
+                    )]
+                    for audio in video_info['audio_options']
+                ]
             elif choice == "video":
-                for video in video_info['video_options']:
-                    keyboard.append([
-                        InlineKeyboardButton(
-                            f"🎬 {video['quality']} ({video.get('ptype','prog')})",
-                            callback_data=f"download|{vid_id}|{video['itag']}|video|{video['quality']}|{video.get('ptype','prog')}"
-                        )
-                    ])
-            keyboard.append([InlineKeyboardButton("❌ Batal", callback_data="cancel")])
+                keyboard = [
+                    [InlineKeyboardButton(
+                        f"🎬 {video['quality']} ({video.get('ptype','prog')})",
+                        callback_data=f"download|{vid_id}|{video['itag']}|video|{video['quality']}|{video.get('ptype','prog')}"
+                    )]
+                    for video in video_info['video_options']
+                ]
+            else:
+                keyboard = []
+            keyboard.append(_CANCEL_ROW)
             reply_markup = InlineKeyboardMarkup(keyboard)
             text = f"📹 *{video_info['title']}*\n\nPilih opsi {choice.capitalize()}:"
             await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
@@ -480,42 +771,43 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text(
                 f"⬇️ Mengunduh {'audio' if format_type=='audio' else 'video'} dengan kualitas {quality}...\nProses ini mungkin memerlukan waktu beberapa saat."
             )
-            file_path, temp_dir = await download_youtube(url, itag, format_type, user.id, log_id, ptype)
-            if file_path:
-                await query.edit_message_text("✅ Pengunduhan selesai! Mengirim file...")
-                try:
-                    if format_type == 'audio':
-                        await asyncio.wait_for(
-                            context.bot.send_audio(
-                                chat_id=user.id,
-                                audio=open(file_path, 'rb'),
-                                caption=f"🎵 Audio {quality}"
-                            ),
-                            timeout=3600  # Timeout 1 jam
-                        )
-                    else:
-                        await asyncio.wait_for(
-                            context.bot.send_video(
-                                chat_id=user.id,
-                                video=open(file_path, 'rb'),
-                                caption=f"🎬 Video {quality}"
-                            ),
-                            timeout=3600  # Timeout 1 jam
-                        )
-                    os.remove(file_path)
-                    if temp_dir and os.path.exists(temp_dir):
-                        shutil.rmtree(temp_dir)
-                    await query.edit_message_text("✅ File berhasil dikirim! Kirim URL lain untuk mengunduh video/audio lainnya.")
-                except Exception as e:
-                    error_msg = f"Error mengirim file: {str(e)}"
-                    logger.error(error_msg)
-                    update_log_status(log_id, "failed_to_send", error_msg)
-                    if "Request Entity Too Large" in str(e):
-                        await query.edit_message_text("❌ File terlalu besar untuk dikirim melalui Telegram (batas 50MB).\nCoba pilih kualitas yang lebih rendah.")
-                    else:
-                        await query.edit_message_text("❌ Pengunduhan berhasil, tetapi gagal mengirim file.\nSilakan coba lagi nanti atau pilih format lain.")
-            else:
-                await query.edit_message_text("❌ Gagal mengunduh file. Silakan coba format lain atau URL video yang berbeda.")
+            # Direktori temporary dihapus otomatis setelah file terkirim, termasuk saat error
+            with tempfile.TemporaryDirectory() as temp_dir:
+                # Batasi jumlah unduhan + proses ffmpeg yang berjalan bersamaan
+                async with _DOWNLOAD_SEMAPHORE:
+                    file_path = await download_youtube(url, itag, format_type, user.id, log_id, temp_dir, ptype)
+                if file_path:
+                    await query.edit_message_text("✅ Pengunduhan selesai! Mengirim file...")
+                    try:
+                        if format_type == 'audio':
+                            await asyncio.wait_for(
+                                context.bot.send_audio(
+                                    chat_id=user.id,
+                                    audio=Path(file_path),
+                                    caption=f"🎵 Audio {quality}"
+                                ),
+                                timeout=3600  # Timeout 1 jam
+                            )
+                        else:
+                            await asyncio.wait_for(
+                                context.bot.send_video(
+                                    chat_id=user.id,
+                                    video=Path(file_path),
+                                    caption=f"🎬 Video {quality}"
+                                ),
+                                timeout=3600  # Timeout 1 jam
+                            )
+                        await query.edit_message_text("✅ File berhasil dikirim! Kirim URL lain untuk mengunduh video/audio lainnya.")
+                    except Exception as e:
+                        error_msg = f"Error mengirim file: {str(e)}"
+                        logger.error(error_msg)
+                        update_log_status(log_id, "failed_to_send", error_msg)
+                        if "Request Entity Too Large" in str(e):
+                            await query.edit_message_text("❌ File terlalu besar untuk dikirim melalui Telegram (batas 50MB).\nCoba pilih kualitas yang lebih rendah.")
+                        else:
+                            await query.edit_message_text("❌ Pengunduhan berhasil, tetapi gagal mengirim file.\nSilakan coba lagi nanti atau pilih format lain.")
+                else:
+                    await query.edit_message_text("❌ Gagal mengunduh file. Silakan coba format lain atau URL video yang berbeda.")
     except Exception as e:
         error_msg = f"Error in button handler: {str(e)}"
         logger.error(error_msg)
@@ -537,8 +829,21 @@ async def error_handler(update, context):
 
 def main():
     try:
+        if not _BOT_TOKEN:
+            logger.critical("Environment variable TELEGRAM_BOT_TOKEN belum di-set")
+            return
         init_database()
-        application = ApplicationBuilder().token('8012132104:AAFAUyz7ifY93IpbQGeRpwZ5CZG6w_BHNDo').build()
+        open_connections()
+        application = (
+            ApplicationBuilder()
+            .token(_BOT_TOKEN)
+            .concurrent_updates(MAX_CONCURRENT_UPDATES)
+            .pool_timeout(30)
+            .connection_pool_size(64)
+            .post_init(start_log_writer)
+            .post_shutdown(stop_log_writer)
+            .build()
+        )
         application.add_handler(CommandHandler("start", start_command))
         application.add_handler(CommandHandler("help", help_command))
         application.add_handler(CommandHandler("stats", stats_command))